@@ -3,17 +3,18 @@
 
 # Python standard library
 from __future__ import print_function
-import csv, os, sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+import csv, io, os, re, stat, sys
 
 # Local imports
 from utils import (
-    Colors,
     err,
     fatal
 )
 
 # Constants
-_C = Colors()
 # Required sample sheet field names
 REQUIRED_SAMPLE_SHEET_COLUMNS = [
     "sample",
@@ -35,6 +36,15 @@ OPTIONAL_SAMPLE_SHEET_COLUMNS = [
     "loupe_alignment",
     "barcode_csv"
 ]
+# Optional sample sheet fields that
+# are remapped to a required field
+# when they are missing or empty, i.e.
+# the id field is set to the sample
+# field. Read-only, as it is used as
+# a default argument.
+REMAP_MISSING_SAMPLE_SHEET_COLUMNS = MappingProxyType({
+    "id": "sample"
+})
 # Within the sample sheet, these
 # are the columns that correspond
 # to either files or directories.
@@ -44,7 +54,9 @@ OPTIONAL_SAMPLE_SHEET_COLUMNS = [
 # These are the columns that will
 # be convert to absolute paths and
 # we will check for their existence.
-FILELIKE_SAMPLE_SHEET_COLUMNS = [
+# Stored as a set, as it is only ever
+# used for membership tests.
+FILELIKE_SAMPLE_SHEET_COLUMNS = frozenset([
     "fastqs",
     "cytaimage",
     "image",
@@ -52,18 +64,109 @@ FILELIKE_SAMPLE_SHEET_COLUMNS = [
     "colorizedimage",
     "loupe_alignment",
     "barcode_csv"
-]
+])
+# Checking if a path exists is bound by
+# the latency of the filesystem (i.e.
+# NFS or Lustre), so the directories of
+# many paths are checked concurrently
+# with a pool of threads. Small sample
+# sheets are checked in serial to avoid
+# the cost of starting the thread pool.
+PATH_CHECK_WORKERS = 16
+PATH_CHECK_MIN_PATHS = 64
+# Number of bytes read from the start of
+# a sample sheet to detect its delimiter,
+# and the delimiters that are supported.
+DELIMITER_SAMPLE_SIZE = 4096
+SUPPORTED_DELIMITERS = ",\t"
+# Quotes and common ASCII whitespace
+# characters removed from both ends of
+# each value, any remaining whitespace
+# (i.e. unicode) is removed afterwards
+# with a bare str.strip().
+_STRIPPED_CHARS = '"\' \t\r\n\x0b\x0c'
+# Matches empty lines and comment lines,
+# i.e. lines starting with a '#', along
+# with the line break that precedes them.
+# Line breaks can be \n, \r\n, or \r (i.e.
+# a CSV file exported by Excel on a Mac).
+_SKIPPED_LINES = re.compile(r'(?:\r\n?|\n)[^\S\r\n]*(?:#[^\r\n]*)?(?=[\r\n]|\Z)')
 
 # Helper functions
+def _skip_lines(data):
+    """Removes empty lines and comments (lines starting with a
+    '#' character) from the contents of a file in a single pass.
+    @param data <str>:
+        Contents of a file, lines may end with \\n, \\r\\n, or \\r.
+    @return data <str>:
+        Contents of the file without any empty or comment lines.
+    """
+    # A line break is prepended so the first line
+    # can be matched as well, any leading breaks
+    # that remain belonged to removed lines
+    return _SKIPPED_LINES.sub('', '\n' + data).lstrip('\r\n')
+
+
 def stripped(s):
-    """Cleans string to remove quotes from its leading
-    and trailing ends.
+    """Cleans string to remove quotes and whitespace from
+    its leading and trailing ends, including any unicode
+    whitespace, i.e. non-breaking spaces.
     @param s <str>:
         String to remove quotes or clean
     @return s <str>:
         Cleaned string with quotes removed
     """
-    return s.strip('"').strip("'").strip()
+    return s.strip(_STRIPPED_CHARS).strip()
+
+
+def _unreadable(parent, names):
+    """Finds any files or directories within a parent directory
+    that do not exist or are not readable. Files need read
+    permissions and directories need read and execute permissions.
+    When more than one path shares the parent directory, it is
+    listed once with os.scandir instead of stat-ing each path,
+    this avoids a path walk per file on networked filesystems.
+    @param parent <str>:
+        Absolute path to the parent directory of each path.
+    @param names <list[tuple(str, str)]>:
+        List of (basename, path) tuples to check, where each
+        path is the absolute path to the file or directory.
+    @return errors <list[str]>:
+        Error messages for each path that is not readable,
+        an empty list is returned if all paths are readable.
+    """
+    errors = []
+    entries = {}
+    if len(names) > 1:
+        try:
+            with os.scandir(parent) as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
+            # Parent directory cannot be listed, i.e.
+            # it only has execute permissions, each
+            # path is stat-ed individually instead
+            entries = {}
+    for name, path in names:
+        try:
+            # Paths missing from the listing, i.e. '.',
+            # '..', or a name that differs by case on a
+            # case-insensitive filesystem, fall back to
+            # a single stat call before reporting them
+            is_dir = entries[name].is_dir()
+        except (KeyError, OSError):
+            try:
+                is_dir = stat.S_ISDIR(os.stat(path).st_mode)
+            except OSError:
+                errors.append("Error: '{}' does not exist or is not readable!".format(path))
+                continue
+        if is_dir and not os.access(path, os.R_OK | os.X_OK):
+            # Directories need at least read and execute
+            # permissions to be considered readable
+            errors.append("Error: '{}' does not have read and execute permissions!".format(path))
+        elif not is_dir and not os.access(path, os.R_OK):
+            # Files only need read permissions
+            errors.append("Error: '{}' does not exist or is not readable!".format(path))
+    return errors
 
 
 def readable(path):
@@ -80,25 +183,45 @@ def readable(path):
         error is thrown that will result in a non-zero exit
         code.
     """
-    error = False
-    if not os.access(path, os.R_OK):
-        # Check if the path exists and is readable,
-        # if not, raise an error. Both files and
-        # directories need read permissions.
-        err("Error: '{}' does not exist or is not readable!".format(path))
-        error = True
-    if os.path.isdir(path) and not os.access(path, os.X_OK):
-        # Directories need at least read and execute
-        # permissions to be considered readable
-        err("Error: '{}' does not exist or does not have execute permissions!".format(path))
-        error = True
-    if error:
+    readable_paths([path])
+    return path
+
+
+def readable_paths(paths):
+    """Check the permissions of many files or directories to
+    determine if they are readable, see readable() for more
+    information. Paths are grouped by their parent directory,
+    so each directory is only listed once. Large numbers of
+    directories are checked concurrently. If any path does
+    not exist or is not readable, it will raise an error.
+    @param paths <list[str]>:
+        Absolute paths to the files or directories to check.
+    @return paths <list[str]>
+        Returns the paths if they are all readable, otherwise
+        an error is thrown that will result in a non-zero exit
+        code.
+    """
+    # Group paths by their parent directory,
+    # trailing slashes are removed from dirs
+    parents = {}
+    for path in paths:
+        parent, name = os.path.split(path.rstrip(os.sep) or os.sep)
+        parents.setdefault(parent, []).append((name, path))
+    if len(paths) < PATH_CHECK_MIN_PATHS:
+        errors = list(map(_unreadable, parents.keys(), parents.values()))
+    else:
+        with ThreadPoolExecutor(max_workers=PATH_CHECK_WORKERS) as pool:
+            errors = list(pool.map(_unreadable, parents.keys(), parents.values()))
+    errors = [e for group in errors for e in group]
+    for error in errors:
+        err(error)
+    if errors:
         # If there were errors, raise a fatal error
         # and exit the script with a non-zero exit code
         fatal(
             "  └── Fatal: Please check/update the permissions and try again!"
         )
-    return path
+    return paths
 
 
 def normalize_path(path, cwd=None, check_exists=False):
@@ -124,11 +247,16 @@ def normalize_path(path, cwd=None, check_exists=False):
         and user's home directory (~) will be expanded.
     """
     # Expand user (i.e ~) and environment variables
-    # like $HOME, $SLURM_JOBID, $TMPRDIR, etc.
-    path = os.path.expandvars(os.path.expanduser(path))
-    if cwd is not None:
-        # If a cwd is provided, resolve the path
-        # relative to that specific location
+    # like $HOME, $SLURM_JOBID, $TMPRDIR, etc., skip
+    # the expansion if there is nothing to expand
+    if '~' in path:
+        path = os.path.expanduser(path)
+    if '$' in path:
+        path = os.path.expandvars(path)
+    if cwd is not None and not os.path.isabs(path):
+        # If a cwd is provided, resolve a relative
+        # path relative to that specific location,
+        # absolute paths are already resolved
         if not os.path.isabs(cwd):
             # Display warning to the user an
             # absolute path should be passed
@@ -151,6 +279,113 @@ def normalize_path(path, cwd=None, check_exists=False):
     return path
 
 
+def delimiter(input_file, sample_size=DELIMITER_SAMPLE_SIZE):
+    """Detects the delimiter of a file from its contents. Only
+    the start of the file is read, empty lines and comments are
+    ignored. Only commas and tabs are detected. If the delimiter
+    cannot be sniffed, i.e. rows have different numbers of values,
+    the most common delimiter in the header is used.
+    @param input_file <str>:
+        Delimited file to detect the delimiter of.
+    @param sample_size <int>:
+        Number of characters to read from the start of the file.
+    @return delim <str>:
+        Detected delimiter, or None if it could not be detected.
+    """
+    try:
+        with open(input_file, newline='') as fh:
+            sample = fh.read(sample_size)
+            if fh.read(1):
+                # Drop the last line, it may
+                # have been cut off part way
+                end = max(sample.rfind('\n'), sample.rfind('\r'))
+                if end > 0:
+                    sample = sample[:end]
+    except (OSError, UnicodeDecodeError):
+        # Cannot read the file or it is not a
+        # text file, i.e. an excel workbook
+        return None
+    sample = _skip_lines(sample)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=SUPPORTED_DELIMITERS).delimiter
+    except csv.Error:
+        # Sniffer gives up on ragged files, i.e.
+        # rows missing trailing optional values,
+        # use the most common delimiter in the
+        # header instead
+        header = sample.splitlines()[0] if sample else ''
+        counts = [(header.count(d), d) for d in SUPPORTED_DELIMITERS]
+        count, delim = max(counts)
+        if count:
+            return delim
+        # Could not determine the delimiter
+        return None
+
+
+def read_rows(input_file, delim=','):
+    """Reads a delimited file with a header and yields its
+    header followed by each of its rows as a sequence of
+    values. Empty lines and comments (lines starting with
+    a '#' character) are skipped.
+    @param input_file <str>:
+        Delimited file with a header to parse.
+    @param delim <str>:
+        Delimiter used to separate columns in the file.
+        Default is a comma (',').
+    @yields row <list[str]>:
+        The first item is the header, i.e. a list of column
+        names, and each following item is a row's values in
+        the same order as the header. Rows may be shorter
+        than the header if trailing values are missing.
+    """
+    with open(input_file, newline='') as fh:
+        # Skip empty lines and comments in a
+        # single pass over the whole file
+        data = _skip_lines(fh.read())
+    for row in csv.reader(io.StringIO(data, newline=''), delimiter=delim):
+        yield row
+
+
+@lru_cache(maxsize=None)
+def _row_parser(fields, n_required):
+    """Generates and compiles a function to parse the rows of a
+    file once the index of each of its columns is known. Each
+    field is unrolled into its own assignment, so there is no
+    loop over the fields or bounds checks when a row is parsed.
+    Parsers are cached, so they are only compiled once for
+    each unique set of fields and column indices.
+    @param fields <tuple[tuple(str, int)]>:
+        Tuple of (field, column index) pairs to parse, where
+        the column index is -1 if the field is not in the
+        header. Required fields must be listed first.
+    @param n_required <int>:
+        Number of required fields at the start of fields.
+    @return _parse <function(row, values)>:
+        Function that takes a row (a sequence of values, at
+        least as long as the largest column index) and a
+        dictionary of previously seen values, used to share
+        repeated values. It returns a tuple containing a
+        dictionary of each field's stripped value, and a
+        boolean that is False if any required field is empty.
+    """
+    lines = ["def _parse(row, values):"]
+    for n, (field, i) in enumerate(fields):
+        if i < 0:
+            # Column is missing from
+            # the header, empty value
+            lines.append("    v{0} = ''".format(n))
+            continue
+        lines.append("    v{0} = row[{1}].strip(_STRIPPED_CHARS).strip()".format(n, i))
+        lines.append("    v{0} = values.setdefault(v{0}, v{0})".format(n))
+    lines.append("    return {{{0}}}, bool({1})".format(
+        ", ".join("{0!r}: v{1}".format(field, n) for n, (field, _) in enumerate(fields)),
+        " and ".join("v{0}".format(n) for n in range(n_required)) or "True"
+    ))
+    namespace = {"_STRIPPED_CHARS": _STRIPPED_CHARS}
+    exec("\n".join(lines), namespace)
+    return namespace["_parse"]
+
+
 def index_file(input_file, key, backup_key, required_fields, optional_fields, delim=','):
     """Parses and indexes a file into a dictionary for quick
     lookups later. The file will be indexed as a nested dictionary
@@ -218,30 +453,61 @@ def index_file(input_file, key, backup_key, required_fields, optional_fields, de
     errors = False   # Used to track errors
     file_idx = {}    # Nested dictionary with parsed file
     line_number = 0  # Used for error reporting 
-    with open(input_file, newline='') as fh:
-        # Skip empty lines and comments
-        file = csv.DictReader(
-            (line for line in fh if line.strip() and not line.lstrip().startswith("#")),
-            delimiter=delim
+    values = {}      # Shares repeated values, i.e. slide
+    rows = read_rows(input_file, delim=delim)
+    # Resolve the index of each column once,
+    # columns missing from the header are -1
+    header = next(rows, [])
+    col_idx = {name: i for i, name in enumerate(header)}
+    key_idx = col_idx.get(key, -1)
+    backup_idx = col_idx.get(backup_key, -1)
+    req_idx = [(field, col_idx.get(field, -1)) for field in required_fields]
+    opt_idx = [(field, col_idx.get(field, -1)) for field in optional_fields]
+    missing = [field for field, i in req_idx if i < 0]
+    if header and missing:
+        # Required fields are missing from the
+        # header, every row would be rejected
+        err(
+            "Error: Missing required field(s) '{}' in the header of file '{}'!".format(
+                "', '".join(missing), input_file
+            )
         )
-        for parsed_line in file:
-            line_number += 1
-            # Add first key to file_idx
-            _k1 = stripped(parsed_line.get(key, ''))
-            if not _k1:
-                # Use backup_key if key is empty,
-                # we are indexing by 'id' but
-                # if 'id' is empty we will use
-                # the 'sample' column instead,
-                # 'sample' should always be
-                # present and not empty
-                _k1 = stripped(parsed_line[backup_key])
-            if _k1 not in file_idx:
-                file_idx[_k1] = {}
+        fatal(
+            "  └── Fatal: Please add the missing column(s) to the header and try again."
+        )
+    # Compile a parser specialized for the
+    # resolved column indices of this file
+    parse = _row_parser(tuple(req_idx + opt_idx), len(req_idx))
+    parsed_fields = set(required_fields) | set(optional_fields)
+    width = max([key_idx, backup_idx] + [i for _, i in req_idx + opt_idx]) + 1
+    for row in rows:
+        line_number += 1
+        if len(row) < width:
+            # Missing trailing values, pad
+            # them with empty strings
+            row = list(row) + [''] * (width - len(row))
+        metadata, has_required = parse(row, values)
+        # Add first key to file_idx, reusing the
+        # parsed value when the key is a field
+        if key in parsed_fields:
+            _k1 = metadata[key]
+        else:
+            _k1 = stripped(row[key_idx]) if key_idx >= 0 else ''
+        if not _k1:
+            # Use backup_key if key is empty,
+            # we are indexing by 'id' but
+            # if 'id' is empty we will use
+            # the 'sample' column instead,
+            # 'sample' should always be
+            # present and not empty
+            if backup_key in parsed_fields:
+                _k1 = metadata[backup_key]
+            else:
+                _k1 = stripped(row[backup_idx]) if backup_idx >= 0 else ''
+        if not has_required:
             # Check for required fields
-            for field in required_fields:
-                value = stripped(parsed_line.get(field, ''))
-                if field not in parsed_line or not value:
+            for field, _ in req_idx:
+                if not metadata[field]:
                     # Missing required field from header
                     err(
                         "Error: Missing required field '{}' in line {} of file '{}'!".format(
@@ -249,18 +515,11 @@ def index_file(input_file, key, backup_key, required_fields, optional_fields, de
                         )
                     )
                     errors = True
-                    continue # goto next field
-                # Add required field to file_idx
-                file_idx[_k1][field] = stripped(parsed_line[field])
-            # Check for optional fields
-            for field in optional_fields:
-                value = stripped(parsed_line.get(field, ''))
-                if field not in parsed_line or not value:
-                    # Missing optional field from header,
-                    # or empty value
-                    value = ''
-                # Add optional field to file_idx
-                file_idx[_k1][field] = value
+                    del metadata[field]
+        if _k1 not in file_idx:
+            file_idx[_k1] = metadata
+        else:
+            file_idx[_k1].update(metadata)
     # Check for errors
     if errors:
         fatal(
@@ -273,7 +532,7 @@ def sample_sheet(
         file,
         required_fields=REQUIRED_SAMPLE_SHEET_COLUMNS,
         optional_fields=OPTIONAL_SAMPLE_SHEET_COLUMNS,
-        remap_missing_fields={"id": "sample"},
+        remap_missing_fields=REMAP_MISSING_SAMPLE_SHEET_COLUMNS,
         filelike_fields=FILELIKE_SAMPLE_SHEET_COLUMNS
     ):
     """Parses a sample sheet file and returns an indexed dictionary.
@@ -281,7 +540,8 @@ def sample_sheet(
     @param file <str>:
         Path to the sample sheet file to parse and index. This can be a
         .tsv, .txt, or .csv file. The file must contain a header with
-        the required fields.
+        the required fields. Its delimiter is detected from its contents,
+        if it cannot be detected, it is inferred from its extension.
     @param required_fields <list[str]>:
         List of required field names that must be present in the header.
     @param optional_fields <list[str]>:
@@ -291,8 +551,8 @@ def sample_sheet(
         For example, if the sample sheet does not contain an 'id' field,
         it can be remapped to the 'sample' field which will always be
         present.
-    @param filelike_fields <list[str]>:
-        List of field names that are expected to contain file paths or
+    @param filelike_fields <set[str]>:
+        Set of field names that are expected to contain file paths or
         directories. These fields will be converted to absolute paths and
         checked for existence.
     @return parsed_file <dict[sample][required_fields|optional_fields]=str>:
@@ -305,21 +565,29 @@ def sample_sheet(
         Returns:
         {"A":{"fastqs":"/path/fq1","cytaimage":"Img1","slide":"S1","area":"A1"}}
     """
-    if not os.path.isabs(file):
-        # Conver to an absolute path
-        file = os.path.abspath(os.path.expanduser(os.path.expandvars(file)))
-    if file.endswith('.tsv') or file.endswith('.txt'):
-        # Use tab as delimiter for TSV files
-        delim = '\t'
-    elif file.endswith('.csv'):
-        # Use comma as delimiter for CSV files
-        delim = ','
-    else:
-        # Unsupported file type, not sure what the
-        # delimiter is here or what the user is trying
-        # to do, so we will raise an error.
-        err("Error: Unsupported file type for sample sheet '{0}'. ".format(file))
-        fatal("  └── Fatal: Please provide a .tsv (tab-seperated) or .csv (comma-seperated) file and try again!")
+    # Resolve the sample sheet to an absolute path
+    # once, relative paths within the sample sheet
+    # are resolved from its parent directory
+    file = normalize_path(file)
+    cwd = os.path.dirname(file)
+    # Detect the delimiter from the contents of the
+    # file rather than its extension, a .txt file may
+    # be comma-seperated, falling back to the extension
+    # if the delimiter could not be detected
+    delim = delimiter(file)
+    if delim is None:
+        if file.endswith('.tsv') or file.endswith('.txt'):
+            # Use tab as delimiter for TSV files
+            delim = '\t'
+        elif file.endswith('.csv'):
+            # Use comma as delimiter for CSV files
+            delim = ','
+        else:
+            # Unsupported file type, not sure what the
+            # delimiter is here or what the user is trying
+            # to do, so we will raise an error.
+            err("Error: Unsupported file type for sample sheet '{0}'. ".format(file))
+            fatal("  └── Fatal: Please provide a .tsv (tab-seperated) or .csv (comma-seperated) file and try again!")
     # Parse and index the sample sheet
     parsed_file = index_file(
         file,
@@ -330,8 +598,9 @@ def sample_sheet(
         delim=delim
     )
     # Remap missing fields to a required field
+    remap_fields = list(remap_missing_fields.items())
     for sample, metadata in parsed_file.items():
-        for field, remap_field in remap_missing_fields.items():
+        for field, remap_field in remap_fields:
             if field not in metadata or not metadata[field]:
                 # If the field is missing or empty, remap it
                 # to a known required field. We are using this
@@ -339,17 +608,24 @@ def sample_sheet(
                 # if the 'id' field was not provided or it is
                 # set to an empty string/value.
                 metadata[field] = metadata.get(remap_field, '')
-    # Convert file-like fields to absolute paths
-    for sample, metadata in parsed_file.items():
-        for field in filelike_fields:
-            if field in metadata and metadata.get(field, ''):
-                # Normalize the path to an absolute path
-                # and check if it exists and is readable
-                metadata[field] = normalize_path(
-                    metadata[field],
-                    cwd=os.path.dirname(file),
-                    check_exists=True
-                )
+    # Convert file-like fields to absolute paths,
+    # relative paths are resolved from the location
+    # of the sample sheet
+    filelike = [
+        (metadata, field)
+        for metadata in parsed_file.values()
+        for field in metadata
+        if field in filelike_fields and metadata[field]
+    ]
+    # Normalize each path to an absolute path,
+    # then check if they exist and are readable
+    normalized = [
+        normalize_path(metadata[field], cwd=cwd)
+        for metadata, field in filelike
+    ]
+    readable_paths(normalized)
+    for (metadata, field), path in zip(filelike, normalized):
+        metadata[field] = path
     return parsed_file
 
 